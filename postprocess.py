@@ -1,29 +1,60 @@
+import concurrent.futures
+import contextlib
+import io
 import sys
 
 import postprocess_lib
 
-if __name__ == '__main__':
-    with open(sys.argv[1], 'r') as infile:
-        temp_processor = postprocess_lib.TempProcessor()
+
+def postprocess(filename):
+    with open(filename, 'r') as infile:
+        # BlockProcessor is a TempProcessor, so a single pass over the file
+        # both splits it into blocks and collects the idle/printing
+        # temperatures.
         block_processor = postprocess_lib.BlockProcessor()
-        lines = infile.readlines()
-        # Get the idle temperatures
-        temp_processor.process_lines(lines)
-        # Get the blocks from the original gcode file
-        block_processor.process_lines(lines)
+        block_processor.process_lines(infile)
 
         #for block in block_processor.get_blocks():
         #    print("Block %d of size %d" % (block.state, len(block.lines)))
 
-        print(temp_processor.idle_temps)
+        print(block_processor.idle_temps)
 
         # Modify blocks (copy prime blocks to extruder end positions, overriding
         # feed rate and prepending temp ramp down)
         modified_blocks = postprocess_lib.modify_blocks(
             blocks=block_processor.get_blocks(),
             feedrate_override=200,
-            idle_temps=temp_processor.idle_temps,
-            printing_temps=temp_processor.printing_temps)
+            idle_temps=block_processor.idle_temps,
+            printing_temps=block_processor.printing_temps)
+
+        postprocess_lib.write_blocks_to_file(
+            modified_blocks, postprocess_lib.add_suffix(filename))
+
 
-        with open(postprocess_lib.add_suffix(sys.argv[1]), 'w+') as outfile:
-            postprocess_lib.write_blocks(modified_blocks, outfile)
+def postprocess_logged(filename):
+    """Runs `postprocess` on `filename` and returns everything it printed.
+
+    Used for parallel runs, so that each file's log is printed as one piece
+    instead of interleaving with the logs of the other files.
+    """
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        postprocess(filename)
+    return log.getvalue()
+
+
+if __name__ == '__main__':
+    filenames = sys.argv[1:]
+    if not filenames:
+        print("usage: %s FILE.gcode [FILE.gcode ...]" % sys.argv[0],
+              file=sys.stderr)
+        sys.exit(2)
+    if len(filenames) == 1:
+        postprocess(filenames[0])
+    else:
+        # Files are independent of each other; process them in parallel.
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            for filename, log in zip(
+                    filenames, executor.map(postprocess_logged, filenames)):
+                print("==> %s <==" % filename)
+                print(log, end='')
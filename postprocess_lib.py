@@ -1,8 +1,7 @@
-from __future__ import print_function
-
-import sys
-import re
+import functools
 import os
+import re
+import tempfile
 
 S_INIT = 0
 S_POST_INIT = 1
@@ -14,26 +13,57 @@ S_PART = 6
 S_END = 7
 
 raw_re_state_table = [(';END-INIT', S_POST_INIT),
-                      (';TYPE:(WALL.*|SKIN|FILL)', S_PART),
+                      (';TYPE:(?:WALL|SKIN|FILL)', S_PART),
                       (';TYPE:PRIME-TOWER', S_PRIME_BLOCK),
                       ('; EXTRUDER START HOME', S_START_EXTRUDER),
                       ('; EXTRUDER END HOME', S_END_EXTRUDER)]
 
-compiled_re_state_table = [(re.compile(k), v) for k, v in raw_re_state_table]
+# Patterns dispatched on by Processor.process_line, keyed by handler group
+# name. The state table is folded in as 'state<N>' groups so that each line is
+# matched against a single compiled alternation.
+raw_re_line_table = [
+    ('tool', 'T(?P<tool_number>[0-9]+)$'),
+    ('temp', 'M10[49](?:[ ;]|$)'),
+    ('z_move', r'G[01] [^Z]*Z(?P<z_coordinate>[0-9]+(?:\.[0-9]*)?)'),
+] + [('state%d' % i, k) for i, (k, v) in enumerate(raw_re_state_table)]
+
+state_group_table = dict(
+    ('state%d' % i, v) for i, (k, v) in enumerate(raw_re_state_table))
+
+line_regex = re.compile('|'.join(
+    '(?P<%s>%s)' % (name, pattern) for name, pattern in raw_re_line_table))
+
+# First characters of the lines that can change a TempProcessor's target
+# temperatures: tool changes and M104/M109 commands.
+temp_state_line_first_chars = frozenset('TM')
+
+# First characters of the lines line_regex can match. Used to skip the regex
+# for the bulk of gcode lines, which cannot match it.
+line_regex_first_chars = frozenset('TMG;')
+
+
+def may_match_line_regex(line):
+    """Returns whether the stripped `line` can match a dispatched line_regex
+    group.
+
+    This is a cheap prefilter run on every line before line_regex; keep it in
+    sync with raw_re_line_table.
+    """
+    first_char = line[:1]
+    # Nearly all lines are G0/G1 moves; only Z moves are dispatched.
+    return (first_char in line_regex_first_chars and
+            (first_char != 'G' or 'Z' in line))
+
 
-feed_regex = re.compile('^F([0-9].)?[0-9]*$')
-move_regex = re.compile('^G[01]$')
-move_z_regex = re.compile('^G[01] [^Z]*Z(?P<z_coordinate>[0-9](.[0-9]*)?).*$')
-temp_regex = re.compile('^M10[49]( T(?P<tool>[0-9]*))? S(?P<temp>[0-9]*)$')
-tool_regex = re.compile('^T(?P<tool>[0-9]*)$')
-z_regex = re.compile('^Z([0-9].)?[0-9]*$')
+# Anchored at the end so that it also rejects ops like G10 when used with
+# `rewrite`, which only matches op prefixes.
+move_regex = re.compile('G[01]$')
+temp_op_regex = re.compile('M10[49]')
 
 
 def parse_gcode(line):
     """Parses gcode line into a tuple of (operation, arguments)."""
-    if ';' in line:
-        line = line[:line.find(';')]
-    line = line.strip()
+    line = line.partition(';')[0].strip()
     if line == '':
         return (None, {})
     parts = line.split(' ')
@@ -41,13 +71,25 @@ def parse_gcode(line):
     args = parts[1:]
     args_dict = {}
     for arg in args:
+        value = arg[1:]
+        # Most coordinates are decimals; parse those directly rather than
+        # raising and catching a ValueError from int() for each of them.
+        if '.' in value:
+            args_dict[arg[0]] = float(value)
+            continue
         try:
-            args_dict[arg[0]] = int(arg[1:])
+            args_dict[arg[0]] = int(value)
         except ValueError as e:
-            args_dict[arg[0]] = float(arg[1:])
+            args_dict[arg[0]] = float(value)
     return (op, args_dict)
 
 
+def gcode_op(line):
+    """Returns the op of a gcode line, as `parse_gcode` would, without
+    parsing its arguments. Returns '' for lines without an op."""
+    return line.partition(';')[0].strip().partition(' ')[0]
+
+
 def make_gcode(op, args_dict):
     """Makes a gcode line out of an operation and arguments."""
     args = [op]
@@ -94,59 +136,99 @@ def rewrite(gcode_string, op_regex, override={}, force={}, delete=[]):
     return make_gcode(op, args_dict)
 
 
+@functools.lru_cache(maxsize=None)
+def make_temp_gcode(op, tool, temperature):
+    """Makes an M104/M109 line setting `tool` to `temperature`.
+
+    The set of (tool, temperature) pairs in a print is small, so the formatted
+    lines are cached and shared between blocks.
+    """
+    return '%s T%d S%d' % (op, tool, temperature)
+
+
 class Processor(object):
 
     def __init__(self):
         self.active_tool = 0
-        self.line_processors = [self.process_tool_change, self.process_z_move]
         self.current_z = 0
-
-    def process_tool_change(self, line):
-        """Determines if this line is a tool change line, and updates state
-        accordingly."""
-        match = tool_regex.match(line)
+        # Maps line_regex group names to handlers, called as
+        # handler(line, match) for lines matching that group.
+        self.handlers = {
+            'tool': self.process_tool_change,
+            'z_move': self.process_z_move,
+        }
+
+    def process_tool_change(self, line, match):
+        """Updates the active tool from a tool change line."""
+        self.active_tool = int(match.group('tool_number'))
+
+    def process_z_move(self, line, match):
+        self.current_z = float(match.group('z_coordinate'))
+
+    def dispatch(self, line):
+        """Dispatches a stripped `line` to the handler registered for the
+        line_regex group it matches, if any.
+
+        Returns:
+          str: The name of the matched group, or None.
+        """
+        if not may_match_line_regex(line):
+            return None
+        return self.dispatch_unfiltered(line)
+
+    def dispatch_unfiltered(self, line):
+        """Like `dispatch`, for lines already known to pass
+        `may_match_line_regex`."""
+        match = line_regex.match(line)
         if match is None:
-            return False
-        self.active_tool = int(match.groupdict()['tool'])
-        return True
-
-    def process_z_move(self, line):
-        match = move_z_regex.match(line)
-        if match is None:
-            return False
-        self.current_z = float(match.groupdict()['z_coordinate'])
-        return True
+            return None
+        handler = self.handlers.get(match.lastgroup)
+        if handler is not None:
+            handler(line, match)
+        return match.lastgroup
 
     def process_line(self, line):
-        for line_processor in self.line_processors:
-            line_processor(line.strip())
+        self.dispatch(line.strip())
 
     def process_lines(self, lines):
+        process_line = self.process_line
         for line in lines:
-            self.process_line(line)
+            process_line(line)
 
 
 class TempProcessor(Processor):
 
     def __init__(self):
-        super(TempProcessor, self).__init__()
-        self.line_processors.append(self.process_temp_change)
+        super().__init__()
+        self.handlers['temp'] = self.process_temp_change
         self.idle_temps = {}
         self.printing_temps = {}
         self.target_temps = {}
         self.reached_target = {}
 
-    def process_temp_change(self, line):
-        """Determines if this line is a temperature change line, and updates
-        state accordingly."""
+    def process_temp_change(self, line, match):
+        """Updates temperature state from a temperature change line."""
         op, args = parse_gcode(line)
-        if op is None:
-            return False
-        if not (op == "M104" or op == "M109"):
-            return False
+        self.update_temps(op, args)
+
+    def scan_temperature_lines(self, lines):
+        """Updates the temperature state from `lines`.
+
+        A fast path for Block.update_finish_temperatures, which rescans blocks
+        several times each: lines are dispatched directly, bypassing
+        `process_line` (and any subclass override of it). Lines that fail
+        may_match_line_regex skip the dispatch entirely.
+        """
+        dispatch_unfiltered = self.dispatch_unfiltered
+        for line in lines:
+            line = line.strip()
+            if may_match_line_regex(line):
+                dispatch_unfiltered(line)
 
+    def update_temps(self, op, args):
+        """Updates temperature state from a parsed M104/M109 command."""
         extruder = self.active_tool
-        if 'T' in args.keys():
+        if 'T' in args:
             extruder = args['T']
 
         temperature = args['S']
@@ -159,73 +241,57 @@ class TempProcessor(Processor):
             self.reached_target[extruder] = True
 
         if temperature == 0:
-            return True
-
-        self.update_idle_temps(extruder, temperature)
-        self.update_printing_temps(extruder, temperature)
-        return True
-
-    def update_idle_temps(self, extruder, temperature):
-        if not extruder in self.idle_temps:
-            self.idle_temps[extruder] = temperature
-            return
-
-        old_min_temp = self.idle_temps[extruder]
-        if old_min_temp > temperature:
-            self.idle_temps[extruder] = temperature
-        return
-
-    def update_printing_temps(self, extruder, temperature):
-        if not extruder in self.printing_temps:
-            self.printing_temps[extruder] = temperature
             return
 
-        old_max_temp = self.printing_temps[extruder]
-        if old_max_temp < temperature:
-            self.printing_temps[extruder] = temperature
-        return
+        self.idle_temps[extruder] = min(
+            self.idle_temps.get(extruder, temperature), temperature)
+        self.printing_temps[extruder] = max(
+            self.printing_temps.get(extruder, temperature), temperature)
 
 
 class TempMinimizeProcessor(TempProcessor):
 
     def __init__(self):
-        super(TempMinimizeProcessor, self).__init__()
-        self.line_processors = [self.process_temp_line] + self.line_processors
+        super().__init__()
+        self.handlers['temp'] = self.process_temp_line
 
         self.lines = []
 
-    def process_temp_line(self, line):
-        op, args = parse_gcode(line)
-
-        if not (op == "M104" or op == "M109"):
+    def process_line(self, line):
+        line = line.strip()
+        if self.dispatch(line) != 'temp':
             self.lines.append(line)
-            return
+
+    def process_temp_line(self, line, match):
+        """Drops temperature lines that would not change the target
+        temperature, then updates temperature state."""
+        op, args = parse_gcode(line)
 
         extruder = self.active_tool
-        if 'T' in args.keys():
+        if 'T' in args:
             extruder = args['T']
 
-        if extruder not in self.target_temps.keys():
+        if extruder not in self.target_temps:
             self.lines.append(line)
-            return
-
-        if self.target_temps[extruder] == args['S']:
-            # Target temperature has already been set
-            if op == 'M104':
-                return
-
+        elif self.target_temps[extruder] != args['S']:
+            self.lines.append(line)
+        elif op == 'M109' and not self.reached_target[extruder]:
             # For M109, we need to be sure that the temp has been reached to
             # remove
-            if self.reached_target[extruder]:
-                return
+            self.lines.append(line)
 
-        self.lines.append(line)
+        self.update_temps(op, args)
 
     def get_lines(self):
         return self.lines
 
 
 class Block(object):
+    # Blocks are created for every state transition and copied repeatedly by
+    # modify_blocks; slots avoid a per-instance __dict__.
+    __slots__ = ('lines', 'state', 'start_z', 'finish_z', 'active_tool',
+                 'finish_target_temps', 'finish_reached_target',
+                 'has_temp_ops')
 
     def __init__(self,
                  lines,
@@ -234,7 +300,8 @@ class Block(object):
                  finish_z=0,
                  active_tool=0,
                  finish_target_temps={},
-                 finish_reached_target={}):
+                 finish_reached_target={},
+                 has_temp_ops=True):
         self.lines = lines
         self.state = state
         self.start_z = start_z
@@ -244,26 +311,37 @@ class Block(object):
         self.active_tool = active_tool
         self.finish_target_temps = finish_target_temps
         self.finish_reached_target = finish_reached_target
+        # Whether `lines` may contain ops matching temp_op_regex (M104/M109).
+        # BlockProcessor knows this from its single pass over the file, which
+        # lets modify_blocks skip rescanning blocks without any.
+        self.has_temp_ops = has_temp_ops
 
     def copy(self):
         return Block(self.lines[:], self.state, self.start_z, self.finish_z,
-                     self.active_tool, dict(self.finish_target_temps.items()),
-                     dict(self.finish_reached_target.items()))
+                     self.active_tool, self.finish_target_temps.copy(),
+                     self.finish_reached_target.copy(), self.has_temp_ops)
+
+    def shallow_copy(self):
+        """Like `copy`, but shares `lines` with this block.
+
+        Only for callers that discard this block afterwards, or that never
+        modify either block's `lines` in place.
+        """
+        return Block(self.lines, self.state, self.start_z, self.finish_z,
+                     self.active_tool, self.finish_target_temps.copy(),
+                     self.finish_reached_target.copy(), self.has_temp_ops)
 
     def copy_empty_lines(self):
         return Block([], self.state, self.start_z, self.finish_z,
-                     self.active_tool, dict(self.finish_target_temps.items()),
-                     dict(self.finish_reached_target.items()))
+                     self.active_tool, self.finish_target_temps.copy(),
+                     self.finish_reached_target.copy())
 
-    def remove_matching_ops(self, op_regex_string):
-        op_regex = re.compile(op_regex_string)
+    def remove_matching_ops(self, op_regex):
+        """Removes lines whose op matches the compiled `op_regex`."""
         new_lines = []
         for line in self.lines:
-            op, args = parse_gcode(line)
-            if op is None:
-                new_lines.append(line)
-                continue
-            if op_regex.match(op):
+            op = gcode_op(line)
+            if op and op_regex.match(op):
                 continue
             new_lines.append(line)
         self.lines = new_lines
@@ -271,149 +349,227 @@ class Block(object):
     def add_temperatures(self, wait, idle_temps, printing_temps,
                          start_target_temps, start_reached_target):
         # (idle|printing)_temps are dicts of tool_number -> temperature
-        new_lines = []
-        extruding = False
-        for line in self.lines:
-            op, args = parse_gcode(line)
-            # On the first line with an extrusion movement
-            if 'E' in args.keys() and not extruding:
-                # If the active tool has not reached temperature
-                reached_temperature = lambda: ((start_target_temps[
-                    self.active_tool] == printing_temps[self.active_tool]) and
-                                               start_reached_target[
-                                                   self.active_tool])
-                if not ((self.active_tool in start_target_temps.keys()) and
-                        reached_temperature()):
-                    new_lines.append('M10%s T%d S%d' %
-                                     (('9' if wait else '4'), self.active_tool,
-                                      printing_temps[self.active_tool]))
-                extruding = True
-            new_lines.append(line)
-        self.lines = new_lines
+        tool = self.active_tool
+        # Find the first line with an extrusion movement
+        for index, line in enumerate(self.lines):
+            # Equivalent to testing for 'E' in parse_gcode(line)'s arguments:
+            # every argument is preceded by a space.
+            if ' E' in line and ' E' in line.partition(';')[0]:
+                break
+        else:
+            index = None
+
+        if index is not None:
+            printing_temp = printing_temps[tool]
+            # If the active tool has not reached temperature
+            if not (tool in start_target_temps and
+                    start_target_temps[tool] == printing_temp and
+                    start_reached_target[tool]):
+                temp_line = make_temp_gcode('M109' if wait else 'M104', tool,
+                                            printing_temp)
+                self.lines = (self.lines[:index] + [temp_line] +
+                              self.lines[index:])
         self.update_finish_temperatures(start_target_temps,
                                         start_reached_target)
 
     def update_finish_temperatures(self, start_target_temps,
                                    start_reached_target):
-        temp_minimize_processor = TempMinimizeProcessor()
-        temp_minimize_processor.target_temps = start_target_temps
-        temp_minimize_processor.reached_target = start_reached_target
-
-        temp_minimize_processor.process_lines(self.lines)
-        self.finish_target_temps = temp_minimize_processor.target_temps
-        self.finish_reached_target = temp_minimize_processor.reached_target
+        # Only the resulting target temperatures are needed here, so a plain
+        # TempProcessor suffices; it does not keep a copy of every line.
+        temp_processor = TempProcessor()
+        temp_processor.target_temps = start_target_temps
+        temp_processor.reached_target = start_reached_target
+
+        # Tool changes and temperature commands are the only lines that can
+        # change the target temperatures; select them up front so the bulk of
+        # the block never reaches the dispatch loop.
+        temp_processor.scan_temperature_lines([
+            line for line in self.lines
+            if line[:1] in temp_state_line_first_chars
+        ])
+        self.finish_target_temps = temp_processor.target_temps
+        self.finish_reached_target = temp_processor.reached_target
 
 
 class BlockProcessor(TempProcessor):
 
     def __init__(self):
-        super(BlockProcessor, self).__init__()
-        self.line_processors.append(self.process_blocks)
-
-        self.blocks = []
-
-        # Current block state. Allows modifying at any point before committing
-        # to the block list.
-        self.current_block = Block([])
-
-    def process_blocks(self, line):
-        for re, state in compiled_re_state_table:
-            if re.match(line):
-                # Append the previous current block before starting work on the
-                # new one.
-                self.current_block.finish_target_temps = dict(
-                    self.target_temps.items())
-                self.current_block.finish_reached_target = dict(
-                    self.reached_target.items())
-                self.blocks.append(self.current_block)
-
-                self.current_block = Block(lines=[],
-                                           state=state,
-                                           start_z=self.current_z,
-                                           active_tool=self.active_tool)
-
+        super().__init__()
+        for group in state_group_table:
+            self.handlers[group] = self.process_block_start
+
+        # Current block state. Allows modifying at any point before it is
+        # superseded by the next block. The current block is always the last
+        # entry of `blocks`.
+        self.current_block = Block([], has_temp_ops=False)
+        self.blocks = [self.current_block]
+
+    def dispatch_unfiltered(self, line):
+        group = super().dispatch_unfiltered(line)
+        # Uses the same op test as remove_matching_ops(temp_op_regex) in
+        # modify_blocks, so that no block it would change is skipped. Every
+        # line starting with 'M' gets here (see may_match_line_regex).
+        if line[:1] == 'M' and temp_op_regex.match(gcode_op(line)):
+            self.current_block.has_temp_ops = True
+        return group
+
+    def process_z_move(self, line, match):
+        super().process_z_move(line, match)
         self.current_block.finish_z = self.current_z
+
+    def process_block_start(self, line, match):
+        # Finish the previous current block before starting work on the new
+        # one.
+        self.current_block.finish_target_temps = self.target_temps.copy()
+        self.current_block.finish_reached_target = self.reached_target.copy()
+
+        self.current_block = Block(lines=[],
+                                   state=state_group_table[match.lastgroup],
+                                   start_z=self.current_z,
+                                   finish_z=self.current_z,
+                                   active_tool=self.active_tool,
+                                   has_temp_ops=False)
+        self.blocks.append(self.current_block)
+
+    def process_line(self, line):
+        line = line.strip()
+        self.dispatch(line)
         self.current_block.lines.append(line)
 
+    def process_lines(self, lines):
+        # Same as calling process_line on each line, inlined since this loop
+        # runs once for every line of the input file. Lines that fail the
+        # may_match_line_regex prefilter skip the dispatch entirely.
+        dispatch_unfiltered = self.dispatch_unfiltered
+        for line in lines:
+            line = line.strip()
+            if may_match_line_regex(line):
+                dispatch_unfiltered(line)
+            self.current_block.lines.append(line)
+
     def get_blocks(self):
-        return self.blocks + [self.current_block]
+        return self.blocks
 
 
 class PrimeRetraceProcessor(Processor):
 
     def __init__(self, idle_temps, feed_override, active_tool, z_override):
-        super(PrimeRetraceProcessor, self).__init__()
+        super().__init__()
         self.feed_override = feed_override
         self.z_override = z_override
+        self.rewrite_travel_move = make_move_rewriter(feed_override * 15, None)
+        self.rewrite_lowering_move = make_move_rewriter(feed_override,
+                                                        z_override)
+        self.rewrite_wipe_move = make_move_rewriter(feed_override, None)
 
         self.lines = [";WIPE-PRIME-TOWER"]
 
         self.idle_temps = idle_temps
         if self.idle_temps is not None:
             for tool, idle_temp in idle_temps.items():
-                self.lines.append("M104 T%d S%d" % (tool, idle_temp))
-
-            self.active_idle_line = "M109 T%d S%d" % (active_tool,
-                                                      idle_temps[active_tool])
+                self.lines.append(make_temp_gcode('M104', tool, idle_temp))
 
-        self.line_processors.append(self.process_prime_line)
+            self.active_idle_line = make_temp_gcode('M109', active_tool,
+                                                    idle_temps[active_tool])
 
         self.seen_move_line = False
+        self.finished = False
+
+    def process_line(self, line):
+        line = line.strip()
+        self.dispatch(line)
+        self.process_prime_line(line)
 
     def process_prime_line(self, line):
         # Up until the first move command, rewrite normally.
         if not self.seen_move_line:
             # Make sure it's a move command with X or Y coordinate (so that
-            # it's not just a feedrate config G command)
-            if line.startswith('G') and ('X' in line or 'Y' in line):
+            # it's not just a feedrate config G command). Only the few lines
+            # before the first move get here, so parsing them is cheap.
+            op, args = parse_gcode(line)
+            if (op is not None and move_regex.fullmatch(op) and
+                    ('X' in args or 'Y' in args)):
                 # At the first move command, rewrite normally.
                 self.seen_move_line = True
-                self.lines.append(
-                    rewrite_move(line, self.feed_override * 15, None))
+                self.lines.append(self.rewrite_travel_move(line))
                 # Repeat the first move command, lowering to the correct Z.
-                self.lines.append(
-                    rewrite_move(line, self.feed_override, self.z_override))
+                self.lines.append(self.rewrite_lowering_move(line))
                 return
 
             # For lines before we jog down in Z, we can move fast(er).
-            self.lines.append(rewrite_move(line, self.feed_override * 15, None))
+            self.lines.append(self.rewrite_travel_move(line))
             return
         # TODO: Feed rate override, no extruder moves, no Z
-        self.lines.append(rewrite_move(line, self.feed_override, None))
+        self.lines.append(self.rewrite_wipe_move(line))
 
     def get_lines(self):
+        """Returns the wipe lines. Finishes the processor; no further lines
+        may be processed after this is called."""
+        if self.finished:
+            return self.lines
+        self.finished = True
         # Cut the last 5 lines. This is a hack to remove spurious jogs back to
         # the part at the end of the prime tower.
         # TODO: This does not solve the spurious jogs. Replace with a check for
         # whether or not the moves fall into the prime tower bounding box or
         # not.
+        # Trimmed in place rather than sliced, to avoid copying the list.
+        del self.lines[-5:]
         if self.idle_temps is not None:
-            return self.lines[:-5] + [self.active_idle_line]
-        return self.lines[:-5]
+            self.lines.append(self.active_idle_line)
+        return self.lines
+
+
+@functools.lru_cache(maxsize=64)
+def make_move_rewriter(feed_override, z_force):
+    """Makes a function that rewrites a single G0/G1 move line.
+
+    The returned function is equivalent to `rewrite` restricted to G0/G1 ops,
+    overriding F and deleting E, and either deleting Z (`z_force` is None) or
+    forcing it to `z_force`. The replacement arguments are formatted once here,
+    and the line is rebuilt in a single pass over its tokens rather than
+    round-tripping through `parse_gcode`/`make_gcode`. Rewriters are cached
+    per (`feed_override`, `z_force`).
+    """
+    feed_token = 'F%s' % feed_override
+    z_token = None if z_force is None else 'Z%s' % z_force
+
+    def rewrite_move_line(line):
+        tokens = line.partition(';')[0].split()
+        if not tokens or not move_regex.fullmatch(tokens[0]):
+            return line
+        rewritten = [tokens[0]]
+        seen_z = False
+        for token in tokens[1:]:
+            key = token[0]
+            if key == 'F':
+                rewritten.append(feed_token)
+            elif key == 'Z':
+                seen_z = True
+                if z_token is not None:
+                    rewritten.append(z_token)
+            elif key != 'E':
+                rewritten.append(token)
+        if z_token is not None and not seen_z:
+            rewritten.append(z_token)
+        return ' '.join(rewritten)
+
+    return rewrite_move_line
 
 
 def rewrite_move(line, feed_override, z_force):
-    if z_force is None:
-        return rewrite(line,
-                       move_regex,
-                       override={'F': feed_override},
-                       delete=['E', 'Z'])
-    return rewrite(line,
-                   move_regex,
-                   override={'F': feed_override},
-                   force={'Z': z_force},
-                   delete=['E'])
+    return make_move_rewriter(feed_override, z_force)(line)
 
 
 class PrimeProcessor(Processor):
 
     def __init__(self, active_tool, pre_ramp, idle_temps, printing_temps,
                  feed_override):
-        super(PrimeProcessor, self).__init__()
+        super().__init__()
         self.pre_ramp = pre_ramp
         self.pre_lines = [";PRE-PRIME-TOWER"]
-        self.pre_lines.append("M104 T%d S%d" %
-                              (active_tool, printing_temps[active_tool]))
+        self.pre_lines.append(
+            make_temp_gcode('M104', active_tool, printing_temps[active_tool]))
 
         self.printing_temps = printing_temps
         self.active_tool = active_tool
@@ -421,7 +577,10 @@ class PrimeProcessor(Processor):
 
         self.lines = []
 
-        self.line_processors.append(self.process_prime_line)
+    def process_line(self, line):
+        line = line.strip()
+        self.dispatch(line)
+        self.process_prime_line(line)
 
     def process_prime_line(self, line):
         self.lines.append(line)
@@ -432,38 +591,77 @@ class PrimeProcessor(Processor):
                 None, self.feed_override, self.active_tool, None)
             warmup_trace_processor.process_lines(self.lines)
             # Hack to get the nozzle to the correct height during warm-up wipe
-            return (self.pre_lines + ["G91", "G0 Z-0.2", "G90"] +
-                    warmup_trace_processor.get_lines() +
-                    ["G91", "G0 Z0.2", "G90"] + self.lines)
-        return self.pre_lines + self.lines
+            lines = self.pre_lines + ["G91", "G0 Z-0.2", "G90"]
+            lines.extend(warmup_trace_processor.get_lines())
+            lines += ["G91", "G0 Z0.2", "G90"]
+        else:
+            lines = self.pre_lines[:]
+        # Build the result in one list rather than through a chain of
+        # concatenations, each of which copies everything before it.
+        lines.extend(self.lines)
+        return lines
 
 
 def write_blocks(blocks, output):
-    for block in blocks:
-        for line in block.lines:
-            output.write(line + '\r\n')
+    """Writes the lines of `blocks` to the text file `output`.
+
+    Lines are terminated with '\\n'; the line ending actually written is set
+    by the `newline` argument `output` was opened with.
+    """
+    # Join each block into one string (bounding peak memory to the largest
+    # block) and hand them all to a single writelines call.
+    output.writelines(
+        '\n'.join(block.lines) + '\n' for block in blocks if block.lines)
 
 
-def append_block(block_list, block):
-    return block_list + [block]
+def write_blocks_to_file(blocks, filename):
+    """Writes the lines of `blocks` to `filename` with '\\r\\n' line endings.
+
+    `blocks` may be a generator that does the block modification as it is
+    consumed. The output is written to a temporary file next to `filename`
+    and only moved into place once every block has been written, so an error
+    partway through never leaves a truncated output file behind.
+    """
+    # A unique temporary file, so that concurrent runs writing the same
+    # output never share one.
+    fd, temp_filename = tempfile.mkstemp(suffix='.tmp',
+                                         dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(fd, 'w', newline='\r\n') as output:
+            write_blocks(blocks, output)
+        # mkstemp creates the file readable only by its owner; give the output
+        # the permissions a plainly created file would have.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_filename, 0o666 & ~umask)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
 
 
 def modify_blocks(blocks, feedrate_override, idle_temps, printing_temps):
-    output_blocks = []
+    """Yields the output blocks for `blocks`, in order.
+
+    Blocks are yielded as soon as they are finished so that they can be written
+    out without holding the whole modified file in memory.
+    """
     last_prime_block = Block([])
     last_block = Block([])
     # Hack to make sure that we get the right temperature ramps for the
     # raft/initial prime tower layer
-    seen_first_part_block_tools = []
+    seen_first_part_block_tools = set()
     for block in blocks:
         if block.state == S_INIT:
-            output_blocks = append_block(output_blocks, block)
+            yield block
             last_block = block
             continue
         # Remove temperature lines from all but the initial block. We will
         # completely override them.
-        if set(seen_first_part_block_tools) == set(idle_temps.keys()):
-            block.remove_matching_ops('M10[49]')
+        if (block.has_temp_ops and
+                seen_first_part_block_tools == idle_temps.keys()):
+            block.remove_matching_ops(temp_op_regex)
 
         block.update_finish_temperatures(last_block.finish_target_temps,
                                          last_block.finish_reached_target)
@@ -495,18 +693,19 @@ def modify_blocks(blocks, feedrate_override, idle_temps, printing_temps):
             new_block.add_temperatures(True, idle_temps, printing_temps,
                                        last_block.finish_target_temps,
                                        last_block.finish_reached_target)
-            output_blocks = append_block(output_blocks, new_block)
+            yield new_block
             last_block = new_block
             continue
 
         if block.state == S_PART:
-            new_block = block.copy()
+            # `block` is not used again, and add_temperatures replaces `lines`
+            # rather than modifying it, so the lines need not be copied.
+            new_block = block.shallow_copy()
             new_block.add_temperatures(False, idle_temps, printing_temps,
                                        last_block.finish_target_temps,
                                        last_block.finish_reached_target)
-            output_blocks = append_block(output_blocks, new_block)
-            seen_first_part_block_tools = set(
-                list(seen_first_part_block_tools) + [new_block.active_tool])
+            yield new_block
+            seen_first_part_block_tools.add(new_block.active_tool)
             last_block = new_block
             continue
 
@@ -541,24 +740,26 @@ def modify_blocks(blocks, feedrate_override, idle_temps, printing_temps):
             prime_wipe_block.update_finish_temperatures(
                 last_block.finish_target_temps,
                 last_block.finish_reached_target)
-            output_blocks = append_block(output_blocks, prime_wipe_block)
+            yield prime_wipe_block
             # Add the end extruder block
             block.update_finish_temperatures(
                 prime_wipe_block.finish_target_temps,
                 prime_wipe_block.finish_reached_target)
-            output_blocks = append_block(output_blocks, block)
+            yield block
             last_block = block
             continue
 
-        output_blocks = append_block(output_blocks, block)
+        yield block
         last_block = block
 
     end_block = Block([])
     end_block.state = S_END
-    end_block.lines = [("M104 T%d S0" % k) for k, v in idle_temps.items()]
-    output_blocks = append_block(output_blocks, end_block)
-
-    return output_blocks
+    # Turn off every tool, in tool order so the output does not depend on the
+    # order the tools were first used in.
+    end_block.lines = [
+        make_temp_gcode('M104', k, 0) for k in sorted(idle_temps)
+    ]
+    yield end_block
 
 
 def add_suffix(filename):
@@ -1,5 +1,8 @@
+import io
+import os
 import unittest
 import re
+import tempfile
 
 import postprocess_lib
 
@@ -73,6 +76,11 @@ class TestPostprocess(unittest.TestCase):
                                     delete=['S']), 'M104 T1 S200')
         self.assertGcodeEqual(postprocess_lib.rewrite_move('G82', 1000, None),
                               'G82')
+        self.assertEqual(
+            postprocess_lib.rewrite('G10 X1 F5',
+                                    op_regex=postprocess_lib.move_regex,
+                                    override={'F': 1},
+                                    delete=['X']), 'G10 X1 F5')
 
     def test_rewrite_matching(self):
         self.assertGcodeEqual(
@@ -85,6 +93,18 @@ class TestPostprocess(unittest.TestCase):
             postprocess_lib.rewrite_move('G1 F6400 X100 Y200', 400, None),
             'G1 F400 X100 Y200')
 
+    def test_rewrite_move_z(self):
+        self.assertEqual(
+            postprocess_lib.rewrite_move('G1 F1800 X1 Y2 Z0.3 E4.5 ; wipe', 400,
+                                         None), 'G1 F400 X1 Y2')
+        self.assertEqual(
+            postprocess_lib.rewrite_move('G1 X1 Z0.3 Y2 E4.5', 400, 1.2),
+            'G1 X1 Z1.2 Y2')
+        self.assertEqual(postprocess_lib.rewrite_move('G0 X1 Y2', 400, 1.2),
+                         'G0 X1 Y2 Z1.2')
+        self.assertEqual(postprocess_lib.rewrite_move('; G0 X1', 400, 1.2),
+                         '; G0 X1')
+
     def test_processor_init(self):
         processor = postprocess_lib.Processor()
         self.assertEquals(processor.active_tool, 0)
@@ -97,6 +117,8 @@ class TestPostprocess(unittest.TestCase):
         self.assertEquals(processor.current_z, 0.5)
         processor.process_line('G0 Z0.9')
         self.assertEquals(processor.current_z, 0.9)
+        processor.process_line('G1 F600 X1 Z10.25 E0.5')
+        self.assertEquals(processor.current_z, 10.25)
 
     def test_processor_tool(self):
         processor = postprocess_lib.Processor()
@@ -108,6 +130,12 @@ class TestPostprocess(unittest.TestCase):
         processor.process_line('T0')
         self.assertEquals(processor.active_tool, 0)
 
+    def test_may_match_line_regex(self):
+        for line in ['T1', 'M104 S200', 'G0 Z0.5', ';TYPE:FILL']:
+            self.assertTrue(postprocess_lib.may_match_line_regex(line))
+        for line in ['', 'G1 X1 Y2 E3', 'E5', '  ']:
+            self.assertFalse(postprocess_lib.may_match_line_regex(line))
+
     def test_temp_processor_init(self):
         temp_processor = postprocess_lib.TempProcessor()
         self.assertEquals(temp_processor.idle_temps, {})
@@ -119,6 +147,35 @@ class TestPostprocess(unittest.TestCase):
         self.assertEquals(temp_processor.idle_temps, IDLE_TEMPS)
         self.assertEquals(temp_processor.printing_temps, PRINTING_TEMPS)
 
+    def test_block_processor_states(self):
+        block_processor = postprocess_lib.BlockProcessor()
+        block_processor.process_lines([
+            "M104 S200", "G0 Z0.3", ";TYPE:PRIME-TOWER", "G1 X1 Y1 E1", "T1",
+            "; EXTRUDER START HOME", ";TYPE:WALL-OUTER", "G1 X2 Y2 E2"
+        ])
+        blocks = block_processor.get_blocks()
+        self.assertEqual([block.state for block in blocks], [
+            postprocess_lib.S_INIT, postprocess_lib.S_PRIME_BLOCK,
+            postprocess_lib.S_START_EXTRUDER, postprocess_lib.S_PART
+        ])
+        self.assertEqual([block.active_tool for block in blocks], [0, 0, 1, 1])
+        self.assertEqual(blocks[1].start_z, 0.3)
+        self.assertEqual(blocks[1].lines,
+                         [";TYPE:PRIME-TOWER", "G1 X1 Y1 E1", "T1"])
+        self.assertEqual(blocks[1].finish_target_temps, {0: 200})
+        self.assertEqual([block.has_temp_ops for block in blocks],
+                         [True, False, False, False])
+
+    def test_block_processor_has_temp_ops(self):
+        block_processor = postprocess_lib.BlockProcessor()
+        block_processor.process_lines([
+            ";TYPE:WALL-OUTER", "G1 X1 Y1 E1", "; M104 S200", ";TYPE:FILL",
+            "M104\tS200", ";TYPE:SKIN", "M109 T1 S210 ; wait"
+        ])
+        self.assertEqual(
+            [block.has_temp_ops for block in block_processor.get_blocks()],
+            [False, False, True, True])
+
     def test_block_temp_annotation(self):
         block = postprocess_lib.Block(lines=[
             "G0 X1 Y1", "G0 X20 Y1", "G1 X2 Y2 E5", "G0 X3 Y10", "G1 X3 Y5 E10"
@@ -167,6 +224,134 @@ class TestPostprocess(unittest.TestCase):
         self.assertEqual(block.finish_target_temps[0], 220)
         self.assertEqual(block.finish_reached_target[0], True)
 
+    def test_write_blocks(self):
+        output = io.StringIO(newline='\r\n')
+        postprocess_lib.write_blocks([
+            postprocess_lib.Block(["G0 X1", "G1 X2 E1"]),
+            postprocess_lib.Block([]),
+            postprocess_lib.Block(["M104 T0 S0"])
+        ], output)
+        self.assertEqual(output.getvalue(),
+                         "G0 X1\r\nG1 X2 E1\r\nM104 T0 S0\r\n")
+
+    def test_write_blocks_to_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'out.gcode')
+            postprocess_lib.write_blocks_to_file(
+                [postprocess_lib.Block(["G0 X1", "G1 X2 E1"])], filename)
+            with open(filename, 'rb') as output:
+                self.assertEqual(output.read(), b"G0 X1\r\nG1 X2 E1\r\n")
+            umask = os.umask(0)
+            os.umask(umask)
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o666 & ~umask)
+            self.assertEqual(os.listdir(directory), ['out.gcode'])
+
+    def test_write_blocks_to_file_failure(self):
+
+        def failing_blocks():
+            yield postprocess_lib.Block(["G0 X1"])
+            raise KeyError(1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'out.gcode')
+            with self.assertRaises(KeyError):
+                postprocess_lib.write_blocks_to_file(failing_blocks(),
+                                                     filename)
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_modify_blocks_failure_writes_no_file(self):
+        # The prime block's tool has no recorded temperatures, so
+        # modify_blocks fails partway through.
+        blocks = [
+            postprocess_lib.Block(["M104 S200"],
+                                  finish_target_temps={0: 200},
+                                  finish_reached_target={0: False}),
+            postprocess_lib.Block([";TYPE:PRIME-TOWER", "G1 X1 Y1 E1"],
+                                  state=postprocess_lib.S_PRIME_BLOCK,
+                                  active_tool=1,
+                                  has_temp_ops=False)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'out.gcode')
+            with self.assertRaises(KeyError):
+                postprocess_lib.write_blocks_to_file(
+                    postprocess_lib.modify_blocks(blocks, 200, {0: 100},
+                                                  {0: 200}), filename)
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_prime_retrace(self):
+        prime_retrace_processor = postprocess_lib.PrimeRetraceProcessor(
+            IDLE_TEMPS, 100, 0, 1.5)
+        prime_retrace_processor.process_lines([
+            ";TYPE:PRIME-TOWER",
+            # Neither of these is a move, so neither is lowered to the Z
+            # override.
+            "G92 X0 Y0",
+            "G1 F1800 ; X5 Y5",
+            "G1 F1800 X5 Y5 E1",
+        ] + ["G1 X%d Y0 E1" % x for x in range(10, 16)])
+        expected_lines = [
+            ";WIPE-PRIME-TOWER",
+            "M104 T0 S100",
+            "M104 T1 S110",
+            ";TYPE:PRIME-TOWER",
+            "G92 X0 Y0",
+            "G1 F1500",
+            "G1 F1500 X5 Y5",
+            "G1 F100 X5 Y5 Z1.5",
+            # Only the first of the wipe moves is kept; the last 5 are cut.
+            "G1 X10 Y0",
+            "M109 T0 S100",
+        ]
+        self.assertEqual(prime_retrace_processor.get_lines(), expected_lines)
+        # Finishing is idempotent: nothing more is cut or appended.
+        self.assertEqual(prime_retrace_processor.get_lines(), expected_lines)
+
+    def test_modify_blocks(self):
+        part = postprocess_lib.S_PART
+        blocks = [
+            postprocess_lib.Block(["M109 T0 S210", "M109 T1 S215"],
+                                  finish_target_temps={
+                                      0: 210,
+                                      1: 215
+                                  },
+                                  finish_reached_target={
+                                      0: True,
+                                      1: True
+                                  }),
+            postprocess_lib.Block([";TYPE:FILL", "G1 X1 Y1 E1"],
+                                  state=part,
+                                  active_tool=0,
+                                  has_temp_ops=False),
+            postprocess_lib.Block([";TYPE:FILL", "G1 X2 Y2 E2"],
+                                  state=part,
+                                  active_tool=1,
+                                  has_temp_ops=False),
+            # Once every tool has printed a part block, temperature commands
+            # are removed, but only from blocks flagged as containing any.
+            postprocess_lib.Block([";TYPE:FILL", "M104 S200", "G1 X3 Y3 E3"],
+                                  state=part,
+                                  active_tool=1,
+                                  has_temp_ops=True),
+            postprocess_lib.Block([";TYPE:FILL", "M104 S200", "G1 X4 Y4 E4"],
+                                  state=part,
+                                  active_tool=1,
+                                  has_temp_ops=False),
+        ]
+        # Not in tool order, to check the end block's ordering.
+        idle_temps = {1: 170, 0: 180}
+        printing_temps = {1: 215, 0: 210}
+        modified_blocks = list(
+            postprocess_lib.modify_blocks(blocks, 200, idle_temps,
+                                          printing_temps))
+        self.assertEqual(modified_blocks[3].lines,
+                         [";TYPE:FILL", "G1 X3 Y3 E3"])
+        self.assertEqual(modified_blocks[4].lines,
+                         [";TYPE:FILL", "M104 S200", "G1 X4 Y4 E4"])
+        self.assertEqual(modified_blocks[-1].state, postprocess_lib.S_END)
+        self.assertEqual(modified_blocks[-1].lines,
+                         ["M104 T0 S0", "M104 T1 S0"])
+
     def test_temp_minimize(self):
         temp_minimize_processor = postprocess_lib.TempMinimizeProcessor()
         lines = [